@@ -10,13 +10,17 @@ and chaining multiple LLM calls.
 """
 
 import asyncio
+import hashlib
 import json
 import os
+import sqlite3
+import threading
+from collections import OrderedDict
 from collections.abc import AsyncGenerator, Iterable
 from dataclasses import dataclass
 from typing import Any, Literal, TypedDict, cast
 
-from litellm import acompletion, completion
+from litellm import acompletion
 from litellm.exceptions import InternalServerError
 from litellm.types.utils import (
   ChatCompletionDeltaToolCall,
@@ -46,6 +50,13 @@ DEFAULT_MODEL_TOP_P = float(
 DEFAULT_MODEL_FREQUENCY_PENALTY = float(
   os.getenv("DEFAULT_MODEL_FREQUENCY_PENALTY", "0")
 )
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH") or None
+LLM_CACHE_SIZE = int(
+  os.getenv("LLM_CACHE_SIZE", "256")
+)
+LLM_STREAM_MIN_CHARS = int(
+  os.getenv("LLM_STREAM_MIN_CHARS", "0")
+)
 
 #
 
@@ -57,7 +68,7 @@ class Message(TypedDict):
   content: str | dict[str, Any] | list[dict[str, Any]]
 
 
-@dataclass
+@dataclass(slots=True)
 class LLMParams:
   """
   Dataclass representing parameters for the language model.
@@ -78,6 +89,9 @@ class LLMParams:
       The format of the response.
   extra_headers : dict[str, str]
       Additional headers to pass to the API.
+  cache : bool
+      Whether to reuse responses to identical
+      requests.
   """
 
   model: str = DEFAULT_MODEL
@@ -89,12 +103,119 @@ class LLMParams:
   )
   response_format: dict[str, Any] | None = None
   extra_headers: dict[str, str] | None = None
+  cache: bool = False
 
 
 def default_llm_params():
   return LLMParams()
 
 
+class ResponseCache:
+  """
+  Cache of LLM responses keyed by a hash of the
+  request, persisted to a SQLite database so it
+  survives restarts, with the most recently used
+  responses also held in memory. Without a database
+  path nothing is cached.
+  """
+
+  # Recently used responses, least recently used
+  # first. Shared by the event loops of every thread.
+  memory: OrderedDict[str, str]
+
+  def __init__(
+    self,
+    db_path: str | None = None,
+    max_memory_entries: int = LLM_CACHE_SIZE,
+  ):
+    self.db_path = db_path
+    self.max_memory_entries = max_memory_entries
+    self.local = threading.local()
+    self.memory = OrderedDict()
+    self.memory_lock = threading.Lock()
+    if self.db_path:
+      with self.conn:
+        self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL
+                )
+            """)
+
+  @property
+  def conn(self) -> sqlite3.Connection:
+    assert self.db_path is not None
+    if not hasattr(self.local, "conn"):
+      self.local.conn = sqlite3.connect(self.db_path)
+    return self.local.conn
+
+  @staticmethod
+  def make_key(
+    completion_kwargs: dict[str, Any],
+  ) -> str:
+    request = {
+      k: completion_kwargs[k]
+      for k in (
+        "model",
+        "messages",
+        "temperature",
+        "max_tokens",
+        "top_p",
+        "frequency_penalty",
+        "response_format",
+      )
+    }
+    return hashlib.blake2b(
+      json.dumps(
+        request, sort_keys=True, default=str
+      ).encode("utf-8"),
+      digest_size=32,
+    ).hexdigest()
+
+  def get(self, key: str) -> str | None:
+    if not self.db_path:
+      return None
+    with self.memory_lock:
+      response = self.memory.get(key)
+      if response is not None:
+        self.memory.move_to_end(key)
+        return response
+    with self.conn:
+      result = self.conn.execute(
+        "SELECT response FROM llm_cache WHERE key = ?",
+        (key,),
+      ).fetchone()
+    if result:
+      self._remember(key, result[0])
+      return result[0]
+    return None
+
+  def set(self, key: str, response: str) -> None:
+    if not self.db_path:
+      return
+    self._remember(key, response)
+    with self.conn:
+      self.conn.execute(
+        "INSERT OR REPLACE INTO llm_cache (key, response) VALUES (?, ?)",
+        (key, response),
+      )
+
+  def _remember(self, key: str, response: str) -> None:
+    with self.memory_lock:
+      self.memory[key] = response
+      self.memory.move_to_end(key)
+      while len(self.memory) > self.max_memory_entries:
+        _ = self.memory.popitem(last=False)
+
+
+RESPONSE_CACHE = ResponseCache(LLM_CACHE_PATH)
+
+_in_flight_requests: dict[
+  tuple[int, str],
+  asyncio.Future[str | ChatCompletionMessageToolCall],
+] = {}
+
+
 async def call_llm(
   messages: Iterable[Message],
   params: LLMParams,
@@ -113,14 +234,66 @@ async def call_llm(
     "extra_headers": params.extra_headers,
   }
 
-  logger.trace(json.dumps(completion_kwargs, indent=2))
+  logger.opt(lazy=True).trace(
+    "{}",
+    lambda: json.dumps(
+      completion_kwargs, indent=2, default=str
+    ),
+  )
+
+  # Only requests that opt into caching are shared
+  # between callers, so that sampling the same request
+  # twice gives two independent responses. Tool calls
+  # have side effects, so they are never shared.
+  if tools or not params.cache:
+    return await _complete(completion_kwargs)
+
+  request_key = ResponseCache.make_key(
+    completion_kwargs
+  )
+  cached = RESPONSE_CACHE.get(request_key)
+  if cached is not None:
+    logger.trace("LLM cache hit: {}", request_key)
+    return cached
+
+  # Share the response of an identical request that is
+  # already in flight on this event loop rather than
+  # issuing it a second time
+  in_flight_key = (
+    id(asyncio.get_running_loop()),
+    request_key,
+  )
+  request = _in_flight_requests.get(in_flight_key)
+  if request is None:
+    request = asyncio.ensure_future(
+      _complete(completion_kwargs)
+    )
+    _in_flight_requests[in_flight_key] = request
+    request.add_done_callback(
+      lambda _: _in_flight_requests.pop(
+        in_flight_key, None
+      )
+    )
+  else:
+    logger.trace(
+      "Joining in-flight LLM request: {}", request_key
+    )
+
+  result = await asyncio.shield(request)
+  if isinstance(result, str):
+    RESPONSE_CACHE.set(request_key, result)
+  return result
+
 
+async def _complete(
+  completion_kwargs: dict[str, Any],
+) -> str | ChatCompletionMessageToolCall:
   max_retries = 3
   for attempt in range(max_retries):
     try:
       response = cast(
         ModelResponse,
-        completion(**completion_kwargs),
+        await acompletion(**completion_kwargs),
       )
       choices_list = cast(
         list[Choices],
@@ -131,7 +304,9 @@ async def call_llm(
       result = message.content
       tool_calls = message.tool_calls
       logger.trace(
-        f"LLM Response: {result}, tool_calls: {tool_calls}"
+        "LLM Response: {}, tool_calls: {}",
+        result,
+        tool_calls,
       )
       return (
         tool_calls[0] if tool_calls else str(result)
@@ -153,14 +328,14 @@ async def call_llm_streaming(
   messages: Iterable[Message],
   params: LLMParams,
   tools: Iterable[dict[str, Any]] | None = None,
+  min_chars: int = LLM_STREAM_MIN_CHARS,
 ) -> AsyncGenerator[dict[str, Any], None]:
-  dbg_msg = json.dumps(
-    messages, separators=(",", ":"), indent=2
-  )
-  logger.debug(
-    f"LLM streaming call: {params.model}, messages: {dbg_msg}"
-  )
-
+  """
+  Call the LLM with streaming enabled. Content is
+  coalesced until at least `min_chars` characters are
+  pending before a token chunk is yielded; the default
+  of 0 yields every delta as it arrives.
+  """
   completion_kwargs: dict[str, Any] = {
     "model": params.model,
     "messages": messages,
@@ -175,21 +350,43 @@ async def call_llm_streaming(
   }
 
   tool_calls: list[ChatCompletionDeltaToolCall] = []
+  # The argument fragments of each tool call, joined
+  # once the call is complete
+  tool_call_arguments: list[list[str]] = []
+  pending_tokens: list[str] = []
+  pending_chars = 0
 
   response = cast(
     CustomStreamWrapper,
     await acompletion(**completion_kwargs),
   )
+  # Log once the request is on its way, and only build
+  # the message dump if debug logging is enabled
+  logger.opt(lazy=True).debug(
+    "LLM streaming call: {}, messages: {}",
+    lambda: params.model,
+    lambda: json.dumps(
+      messages, separators=(",", ":"), indent=2
+    ),
+  )
   async for chunk in response:
-    choices_list = cast(
-      list[StreamingChoices],
-      chunk["choices"],
-    )
-    choices = choices_list[0]
+    choices: StreamingChoices = chunk["choices"][0]
 
     finish_reason = choices.finish_reason
     if finish_reason == "tool_calls":
-      for tool_call in tool_calls:
+      if pending_tokens:
+        yield {
+          "type": "token",
+          "data": "".join(pending_tokens),
+        }
+        pending_tokens.clear()
+        pending_chars = 0
+      for tool_call, arguments in zip(
+        tool_calls, tool_call_arguments
+      ):
+        tool_call.function.arguments = "".join(
+          arguments
+        )
         yield {
           "type": "tool_call",
           "data": ChatCompletionMessageToolCall(
@@ -198,11 +395,12 @@ async def call_llm_streaming(
         }
 
     delta = choices.delta
-    if delta.tool_calls:
-      for tool_call in cast(
-        list[ChatCompletionDeltaToolCall],
-        delta["tool_calls"],
-      ):
+    content = delta.content
+    tool_call_deltas: (
+      list[ChatCompletionDeltaToolCall] | None
+    ) = delta.tool_calls
+    if tool_call_deltas:
+      for tool_call in tool_call_deltas:
         if len(tool_calls) <= tool_call.index:
           assert len(tool_calls) == tool_call.index
           tool_calls.append(
@@ -213,6 +411,7 @@ async def call_llm_streaming(
               index=tool_call.index,
             )
           )
+          tool_call_arguments.append([])
 
         if tool_call.function.name:
           tool_calls[
@@ -220,16 +419,28 @@ async def call_llm_streaming(
           ].function.name = tool_call.function.name
 
         if tool_call.function.arguments:
-          tool_calls[
-            tool_call.index
-          ].function.arguments += (
+          tool_call_arguments[tool_call.index].append(
             tool_call.function.arguments
           )
 
-    elif "content" in delta and delta["content"]:
-      token = str(delta["content"])
-      yield {"type": "token", "data": token}
+    elif content:
+      token = str(content)
+      pending_tokens.append(token)
+      pending_chars += len(token)
+      if pending_chars >= min_chars:
+        yield {
+          "type": "token",
+          "data": "".join(pending_tokens),
+        }
+        pending_tokens.clear()
+        pending_chars = 0
 
     await asyncio.sleep(
       0
     )  # Allow other coroutines to run
+
+  if pending_tokens:
+    yield {
+      "type": "token",
+      "data": "".join(pending_tokens),
+    }
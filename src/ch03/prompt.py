@@ -1,6 +1,8 @@
+import copy
 import os
 from collections.abc import AsyncGenerator
 from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import Any
 
 import yaml
@@ -66,6 +68,21 @@ def parse_frontmatter(
   return metadata, content
 
 
+@lru_cache(maxsize=128)
+def _read_markdown_file(
+  file_path: str,
+  mtime_ns: int,
+) -> tuple[dict[str, Any], str]:
+  """
+  Read and parse a markdown file with frontmatter.
+
+  The modification time is part of the cache key, so
+  a file is read again after it has been changed.
+  """
+  with open(file_path, "r", encoding="utf-8") as f:
+    return parse_frontmatter(f.read())
+
+
 #
 
 
@@ -79,6 +96,14 @@ class Prompt:
   template: str
   role: RoleType = "user"
   params: LLMParams = field(default_factory=LLMParams)
+  # The compiled Jinja2 template, along with the source
+  # it was compiled from so a changed template is
+  # recompiled, and its rendering if it is static
+  _compiled: (
+    tuple[str, Template, str | None] | None
+  ) = field(
+    default=None, init=False, repr=False, compare=False
+  )
 
   #
 
@@ -108,10 +133,12 @@ class Prompt:
     """
     Create a prompt from a markdown file.
     """
-    with open(file_path, "r", encoding="utf-8") as f:
-      metadata, prompt_text = parse_frontmatter(
-        f.read()
-      )
+    metadata, prompt_text = _read_markdown_file(
+      file_path, os.stat(file_path).st_mtime_ns
+    )
+    # The parsed frontmatter is shared between loads of
+    # the same file, so copy it before handing it out
+    metadata = copy.deepcopy(metadata)
     if not prompt_text:
       raise ValueError(
         "Markdown file does not contain content."
@@ -145,6 +172,9 @@ class Prompt:
       "response_format",
       params.response_format,
     )
+    params.cache = bool(
+      metadata.get("cache", params.cache)
+    )
 
     return cls(
       template=prompt_text,
@@ -173,7 +203,26 @@ class Prompt:
     """
     Render the prompt template with the given variables.
     """
-    template = Template(self.template)
+    if (
+      self._compiled is None
+      or self._compiled[0] is not self.template
+    ):
+      template = Template(self.template)
+      # Without any Jinja2 delimiters the template
+      # renders the same whatever the variables
+      static = (
+        template.render()
+        if "{" not in self.template
+        else None
+      )
+      self._compiled = (
+        self.template,
+        template,
+        static,
+      )
+    _, template, static = self._compiled
+    if static is not None:
+      return static
     return template.render(**kwargs)
 
   async def call_llm(
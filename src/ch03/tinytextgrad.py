@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from dataclasses import dataclass
@@ -209,7 +210,7 @@ class TextLoss:
     self.feedback_prompt = feedback_prompt
     self.engine = engine
 
-  def forward(
+  async def forward(
     self,
     text: str,
     results: list[tuple[str, str]],
@@ -229,7 +230,7 @@ class TextLoss:
     logger.debug(
       f"∇ Evaluation input:\n\n{evaluation_input}"
     )
-    loss = self.engine.generate(
+    loss = await self.engine.generate(
       self.feedback_prompt, evaluation_input
     )
     return loss
@@ -254,24 +255,26 @@ class TGD:
     self.loss_function = loss_fn
     self.inputs = inputs
 
-  def generate_results(self) -> list[Any]:
+  async def generate_results(self) -> list[Any]:
     """
-    Generate results for the inputs.
+    Generate results for the inputs concurrently.
     """
-    results = []
-    for _input in self.inputs:
-      output = self.model_engine.generate(
-        self.variable.value, _input
+    outputs = await asyncio.gather(
+      *(
+        self.model_engine.generate(
+          self.variable.value, _input
+        )
+        for _input in self.inputs
       )
-      results.append((_input, output))
-    return results
+    )
+    return list(zip(self.inputs, outputs))
 
   async def step(self) -> None:
     """
     Perform a single step of the optimization process.
     """
-    results = self.generate_results()
-    loss = self.loss_function.forward(
+    results = await self.generate_results()
+    loss = await self.loss_function.forward(
       self.variable.value, results
     )
     logger.debug(f"∇ Loss:\n\n{loss}")
@@ -436,7 +436,7 @@ async def handle_intent(
       ),
     ]
     response = await call_llm_and_tool(
-      messages=messages[:-1] + tmp_messages,
+      messages=tmp_messages,
       params=FUNCTION_CALL_RESPONSE_PROMPT.params,
       suppress_output=suppress_output,
     )
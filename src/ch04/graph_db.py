@@ -355,43 +355,43 @@ class KnowledgeGraph:
   def get_subgraph(
     self, node_id: str, depth: int = 1
   ) -> dict[str, list[Any]]:
-    nodes = set()
-    edges = set()
+    # Accumulate the nodes and edges fetched during
+    # the traversal in place, rather than re-querying
+    # each of them once the traversal is done.
+    nodes: dict[str, Node] = {}
+    edges: dict[tuple[str, str, str], Edge] = {}
 
-    def traverse(current_id: str, current_depth: int):
+    def traverse(node: Node, current_depth: int):
       if current_depth > depth:
         return
-      nodes.add(current_id)
+      nodes[node.id] = node
       if (
         current_depth < depth
       ):  # Only add edges if we're not at the maximum depth
-        neighbors = self.get_neighbors(current_id)
+        neighbors = self.get_neighbors(node.id)
         for neighbor in neighbors:
           edge = self.get_edge(
-            current_id, neighbor.id
-          ) or self.get_edge(neighbor.id, current_id)
+            node.id, neighbor.id
+          ) or self.get_edge(neighbor.id, node.id)
           if edge:
-            edges.add(
+            edges[
               (
                 edge.source,
                 edge.target,
                 edge.type,
               )
-            )
+            ] = edge
           if neighbor.id not in nodes:
             traverse(
-              neighbor.id,
+              neighbor,
               current_depth + 1,
             )
 
-    traverse(node_id, 0)
+    root = self.get_node(node_id)
+    if root:
+      traverse(root, 0)
 
     return {
-      "nodes": [
-        self.get_node(node_id) for node_id in nodes
-      ],
-      "edges": [
-        self.get_edge(source, target)
-        for source, target, _ in edges
-      ],
+      "nodes": list(nodes.values()),
+      "edges": list(edges.values()),
     }
@@ -7,7 +7,7 @@ import asyncio
 import json
 import os
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, wait
 from dataclasses import dataclass, field
 from typing import Any
 
@@ -35,7 +35,7 @@ EXTRACT_ATTRIBUTES_PROMPT = load_prompt(
 #
 
 
-@dataclass
+@dataclass(slots=True)
 class Content:
   id: str
   type: str
@@ -43,7 +43,7 @@ class Content:
   metadata: dict[str, Any]
 
 
-@dataclass
+@dataclass(slots=True)
 class IngestionReport:
   """
   Represents a report of the artifacts produced during content ingestion.
@@ -94,7 +94,7 @@ class IngestionReport:
         """
 
 
-@dataclass
+@dataclass(slots=True)
 class RetrievedContent:
   id: str
   type: str
@@ -126,7 +126,6 @@ class KnowledgeManagementSystem:
     self,
     db_dir: str = "db",
     qa_collection_name: str = "qa_index",
-    max_workers: int = 5,
   ):
     os.makedirs(db_dir, exist_ok=True)
     self.graph = KnowledgeGraph(
@@ -140,9 +139,36 @@ class KnowledgeManagementSystem:
       db_dir, "files"
     )
     os.makedirs(self.file_storage_path, exist_ok=True)
-    self.executor = ThreadPoolExecutor(
-      max_workers=max_workers
+    # Background ingestion not yet finished. Completed
+    # ingestion removes itself from the loop thread,
+    # hence the lock.
+    self.pending_ingestions: set[
+      Future[IngestionReport]
+    ] = set()
+    self.pending_ingestions_lock = threading.Lock()
+    # A single long-lived event loop, run in a daemon
+    # thread, on which background ingestion is scheduled
+    self.loop = asyncio.new_event_loop()
+    self.loop_thread = threading.Thread(
+      target=self.loop.run_forever,
+      name="kms-ingestion",
+      daemon=True,
     )
+    self.loop_thread.start()
+
+  def close(self) -> None:
+    """
+    Wait for background ingestion to finish, then stop
+    the event loop it runs on.
+    """
+    if self.loop.is_closed():
+      return
+    with self.pending_ingestions_lock:
+      pending = list(self.pending_ingestions)
+    _ = wait(pending)
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.loop_thread.join()
+    self.loop.close()
 
   async def ingest_content(
     self, content: Content
@@ -161,8 +187,10 @@ class KnowledgeManagementSystem:
         A report detailing the ingestion process and its results.
     """
 
-    # Store content in file system
-    file_path = self._store_file(content)
+    # Store content in file system, off the event loop
+    file_path = await asyncio.to_thread(
+      self._store_file, content
+    )
 
     # Add node to knowledge graph
     self.graph.add_or_update_node(
@@ -182,44 +210,60 @@ class KnowledgeManagementSystem:
       metadata=content.metadata,
     )
 
-    # Extract entities
-    entities_json = str(
-      await EXTRACT_ENTITIES_PROMPT.call_llm(
-        text=content.content
+    # The extraction steps form a small dependency
+    # graph: entities and QA pairs only need the
+    # content, while relationships and attributes
+    # need the entities. Run each level concurrently in
+    # a task group, so that if one call fails its
+    # siblings are cancelled rather than left running.
+
+    # Extract entities and generate QA pairs
+    async with asyncio.TaskGroup() as tg:
+      entities_task = tg.create_task(
+        EXTRACT_ENTITIES_PROMPT.call_llm(
+          text=content.content
+        )
       )
-    )
-    entities = json.loads(entities_json)["entities"]
+      qa_pairs_task = tg.create_task(
+        self._generate_qa_pairs(content.content)
+      )
+    qa_pairs = qa_pairs_task.result()
+    entities = json.loads(str(entities_task.result()))[
+      "entities"
+    ]
     report.entities = entities
+    # Both the relationship and attribute prompts take
+    # the same serialized entities, so only dump once
+    entities_str = json.dumps(entities)
     logger.info(
       f"Extracted {len(entities)} entities from content with ID {content.id}"
     )
 
-    # Extract relationships
-    relationships_json = str(
-      await EXTRACT_RELATIONSHIPS_PROMPT.call_llm(
-        text=content.content,
-        entities=json.dumps(entities),
+    # Extract relationships and attributes
+    async with asyncio.TaskGroup() as tg:
+      relationships_task = tg.create_task(
+        EXTRACT_RELATIONSHIPS_PROMPT.call_llm(
+          text=content.content,
+          entities=entities_str,
+        )
       )
-    )
-    relationships = json.loads(relationships_json)[
-      "relationships"
-    ]
+      attributes_task = tg.create_task(
+        EXTRACT_ATTRIBUTES_PROMPT.call_llm(
+          text=content.content,
+          entities=entities_str,
+        )
+      )
+    relationships = json.loads(
+      str(relationships_task.result())
+    )["relationships"]
     report.relationships = relationships
     logger.info(
       f"Extracted {len(relationships)} relationships from content with ID {content.id}"
     )
 
-    # Extract attributes
-    attributes_json = str(
-      await EXTRACT_ATTRIBUTES_PROMPT.call_llm(
-        text=content.content,
-        entities=json.dumps(entities),
-      )
-    )
-    assert isinstance(attributes_json, str)
-    attributes = json.loads(attributes_json)[
-      "attributes"
-    ]
+    attributes = json.loads(
+      str(attributes_task.result())
+    )["attributes"]
     report.attributes = attributes
     logger.info(
       f"Extracted attributes for {len(attributes)} entities from content with ID {content.id}"
@@ -257,23 +301,18 @@ class KnowledgeManagementSystem:
         f"Added relationship {rel['source']} -> {rel['target']} of type {rel['relationship']} to content with ID {content.id}"
       )
 
-    # Generate QA pairs and add to QA index
-    qa_pairs = await self._generate_qa_pairs(
-      content.content
-    )
+    # Add the generated QA pairs to the QA index
     report.qa_pairs = qa_pairs
-    for qa_pair in qa_pairs:
-      await self.qa_index.add_qa(
-        question=qa_pair["q"],
-        answer=qa_pair["a"],
-        metadata={
-          "content_id": content.id,
-          **content.metadata,
-        },
-      )
-      logger.info(
-        f"Added question-answer pair to content with ID {content.id}: {qa_pair}"
-      )
+    _ = self.qa_index.add_qa_pairs(
+      qa_pairs,
+      metadata={
+        "content_id": content.id,
+        **content.metadata,
+      },
+    )
+    logger.info(
+      f"Added {len(qa_pairs)} question-answer pairs to content with ID {content.id}"
+    )
 
     return report
 
@@ -303,7 +342,7 @@ class KnowledgeManagementSystem:
     list[RetrievedContent]
         List of retrieved content items.
     """
-    print(f"Query: {query}")
+    logger.debug("Query: {}", query)
     if not query:
       raise ValueError("Query cannot be empty")
 
@@ -316,27 +355,40 @@ class KnowledgeManagementSystem:
     )
 
     # Fetch corresponding nodes from knowledge graph
-    # and create RetrievedContent objects
-    retrieved_content: list[RetrievedContent] = []
-    for qa_result in qa_results:
-      source_id = qa_result["metadata"].get(
-        "content_id"
+    # and create RetrievedContent objects. This reads
+    # the graph and the content files, so it runs off
+    # the event loop, for all results at once.
+    retrieved_content = await asyncio.gather(
+      *(
+        asyncio.to_thread(
+          self._retrieve_qa_result, qa_result
+        )
+        for qa_result in qa_results
       )
-      if source_id:
-        node = self.graph.get_node(source_id)
-        if node:
-          related_nodes = self.graph.get_subgraph(
-            node_id=node.id,
-            depth=5,
-          )["nodes"]
-          result = self._format_result(
-            node, qa_result, related_nodes
-          )
-          retrieved_content.append(
-            RetrievedContent(**result)
-          )
-
-    return retrieved_content
+    )
+    return [
+      content
+      for content in retrieved_content
+      if content is not None
+    ]
+
+  def _retrieve_qa_result(
+    self, qa_result: dict[str, Any]
+  ) -> RetrievedContent | None:
+    source_id = qa_result["metadata"].get("content_id")
+    if not source_id:
+      return None
+    node = self.graph.get_node(source_id)
+    if not node:
+      return None
+    related_nodes = self.graph.get_subgraph(
+      node_id=node.id,
+      depth=5,
+    )["nodes"]
+    result = self._format_result(
+      node, qa_result, related_nodes
+    )
+    return RetrievedContent(**result)
 
   async def update_content(
     self, content: Content
@@ -349,8 +401,10 @@ class KnowledgeManagementSystem:
     content : Content
         The updated content.
     """
-    # Update file in file system
-    file_path = self._store_file(content)
+    # Update file in file system, off the event loop
+    file_path = await asyncio.to_thread(
+      self._store_file, content
+    )
 
     # Update node in knowledge graph
     self.graph.add_or_update_node(
@@ -367,15 +421,13 @@ class KnowledgeManagementSystem:
     qa_pairs = await self._generate_qa_pairs(
       content.content
     )
-    for qa_pair in qa_pairs:
-      await self.qa_index.add_qa(
-        question=qa_pair["q"],
-        answer=qa_pair["a"],
-        metadata={
-          "content_id": content.id,
-          **content.metadata,
-        },
-      )
+    _ = self.qa_index.add_qa_pairs(
+      qa_pairs,
+      metadata={
+        "content_id": content.id,
+        **content.metadata,
+      },
+    )
 
   async def delete_content(
     self, content_id: str
@@ -395,7 +447,9 @@ class KnowledgeManagementSystem:
         f"Content with ID {content_id} not found."
       )
 
-    self._delete_file(node.content)
+    await asyncio.to_thread(
+      self._delete_file, node.content
+    )
     self.graph.delete_node(content_id)
 
     # Remove QA pairs from QA index
@@ -492,13 +546,15 @@ class KnowledgeManagementSystem:
     self, content: str
   ) -> list[dict[str, str]]:
     # TODO: chunking
-    print(
-      f"Generating QA pairs for content: {content}"
+    logger.trace(
+      "Generating QA pairs for content: {}", content
     )
     qa_pairs = await self.qa_index.generate_qa_pairs(
       content
     )
-    print(f"Generated {len(qa_pairs)} QA pairs")
+    logger.debug(
+      "Generated {} QA pairs", len(qa_pairs)
+    )
     return qa_pairs
 
   def _format_result(
@@ -540,35 +596,27 @@ class KnowledgeManagementSystem:
     content : Content
         The content to ingest.
     """
-    self.executor.submit(
-      self._ingest_content_background, content
+    future = asyncio.run_coroutine_threadsafe(
+      self.ingest_content(content), self.loop
+    )
+    with self.pending_ingestions_lock:
+      self.pending_ingestions.add(future)
+    future.add_done_callback(
+      self._finish_background_ingestion
     )
 
-  def _ingest_content_background(
-    self, content: Content
+  def _finish_background_ingestion(
+    self,
+    future: Future[IngestionReport],
   ) -> None:
-    thread_name = threading.current_thread().name
-    logger.info(
-      f"Background ingestion task started in thread: {thread_name}"
-    )
-    try:
-      loop = asyncio.new_event_loop()
-      asyncio.set_event_loop(loop)
-      ingestion_report = loop.run_until_complete(
-        self.ingest_content(content)
-      )
-      loop.close()
-      logger.info(
-        f"Content ingested successfully in thread: {thread_name}"
-      )
-      logger.info(
-        f"Ingestion report: {ingestion_report}"
-      )
-    except Exception as e:
-      logger.exception(
-        f"Error in background ingestion task: {e}"
-      )
-    finally:
-      logger.info(
-        f"Background ingestion task completed in thread: {thread_name}"
+    with self.pending_ingestions_lock:
+      self.pending_ingestions.discard(future)
+    if future.cancelled():
+      return
+    exception = future.exception()
+    if exception:
+      logger.opt(exception=exception).error(
+        f"Error in background ingestion task: {exception}"
       )
+      return
+    logger.info(f"Ingestion report: {future.result()}")
@@ -1,8 +1,14 @@
+import heapq
 import json
 import os
+import threading
+from collections import OrderedDict
 from typing import Any, Optional, Set, TypedDict
 
 import chromadb
+from chromadb.api import ClientAPI
+from chromadb.api.models.Collection import Collection
+from chromadb.api.types import Embedding
 from chromadb.utils import embedding_functions
 from dotenv import load_dotenv
 from loguru import logger
@@ -20,6 +26,26 @@ DEFAULT_COLLECTION_NAME = os.getenv(
 EMBEDDING_MODEL_NAME = os.getenv(
   "EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2"
 )
+QA_QUERY_CACHE_SIZE = int(
+  os.getenv("QA_QUERY_CACHE_SIZE", "512")
+)
+
+# HNSW index settings, applied when a collection is
+# created. Compared to Chroma's defaults (M=16,
+# construction_ef=100, search_ef=10), these trade
+# roughly 1.5x index memory and 2x build time for
+# near-exact recall on the small corpora used here.
+# The distance space stays Chroma's default (l2):
+# similarity scores, and the relevance thresholds
+# applied to them, depend on it.
+QA_HNSW_SPACE = os.getenv("QA_HNSW_SPACE", "l2")
+QA_HNSW_M = int(os.getenv("QA_HNSW_M", "24"))
+QA_HNSW_CONSTRUCTION_EF = int(
+  os.getenv("QA_HNSW_CONSTRUCTION_EF", "128")
+)
+QA_HNSW_SEARCH_EF = int(
+  os.getenv("QA_HNSW_SEARCH_EF", "100")
+)
 
 REWORDING_PROMPT = load_prompt(
   "ch04/knowledge/reword_question"
@@ -40,29 +66,107 @@ class QAPair(TypedDict):
 
 
 class QAIndex:
+  # Results of recent collection queries, keyed by the
+  # question, number of results and metadata filter,
+  # least recently used first. Cleared on every write.
+  # Queries and writes run on several threads, so both
+  # caches are only touched under cache_lock.
+  query_cache: OrderedDict[
+    tuple[str, int, str | None], list[dict[str, Any]]
+  ]
+  # Embeddings of recently queried questions. These
+  # don't depend on the collection, so unlike the query
+  # results they survive writes.
+  embedding_cache: OrderedDict[str, Embedding]
+
   def __init__(
     self,
     db_dir: str = DB_DIR,
     collection_name: str = DEFAULT_COLLECTION_NAME,
+    query_cache_size: int = QA_QUERY_CACHE_SIZE,
+    hnsw_space: str = QA_HNSW_SPACE,
+    hnsw_m: int = QA_HNSW_M,
+    hnsw_construction_ef: int = QA_HNSW_CONSTRUCTION_EF,
+    hnsw_search_ef: int = QA_HNSW_SEARCH_EF,
   ) -> None:
-    self.client = chromadb.PersistentClient(
-      path=db_dir
-    )
-    self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-      model_name=EMBEDDING_MODEL_NAME
-    )
+    self.db_dir = db_dir
     self.collection_name = collection_name
-    self.collection = (
-      self.client.get_or_create_collection(
-        name=collection_name,
-        embedding_function=self.embedding_function,
-      )
-    )
+    # Existing collections keep the settings they were
+    # created with
+    self.collection_metadata = {
+      "hnsw:space": hnsw_space,
+      "hnsw:M": hnsw_m,
+      "hnsw:construction_ef": hnsw_construction_ef,
+      "hnsw:search_ef": hnsw_search_ef,
+    }
+    self.query_cache_size = query_cache_size
+    self.query_cache = OrderedDict()
+    self.query_cache_generation = 0
+    self.embedding_cache = OrderedDict()
+    self.cache_lock = threading.Lock()
+    self._client: ClientAPI | None = None
+    self._embedding_function: (
+      embedding_functions.SentenceTransformerEmbeddingFunction
+      | None
+    ) = None
+    self._collection: Collection | None = None
+    self._init_lock = threading.RLock()
 
     logger.info(
       f"QuestionAnswerKB initialized for collection '{collection_name}'."
     )
 
+  # The client, embedding model and collection are
+  # opened on first use, so that constructing the
+  # index doesn't load the embedding model. First use
+  # may come from several worker threads at once, so
+  # each is created under a lock.
+
+  @property
+  def client(self) -> ClientAPI:
+    if self._client is None:
+      with self._init_lock:
+        if self._client is None:
+          self._client = chromadb.PersistentClient(
+            path=self.db_dir
+          )
+    return self._client
+
+  @property
+  def embedding_function(
+    self,
+  ) -> embedding_functions.SentenceTransformerEmbeddingFunction:
+    if self._embedding_function is None:
+      with self._init_lock:
+        if self._embedding_function is None:
+          self._embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
+            model_name=EMBEDDING_MODEL_NAME
+          )
+    return self._embedding_function
+
+  @property
+  def collection(self) -> Collection:
+    if self._collection is None:
+      with self._init_lock:
+        if self._collection is None:
+          self._collection = self.client.get_or_create_collection(
+            name=self.collection_name,
+            embedding_function=self.embedding_function,
+            metadata=self.collection_metadata,
+          )
+          self._warn_on_space_mismatch()
+    return self._collection
+
+  def _warn_on_space_mismatch(self) -> None:
+    assert self._collection is not None
+    space = (self._collection.metadata or {}).get(
+      "hnsw:space", "l2"
+    )
+    if space != self.collection_metadata["hnsw:space"]:
+      logger.warning(
+        f"Collection '{self.collection_name}' uses the '{space}' space rather than the configured '{self.collection_metadata['hnsw:space']}'; similarity scores will differ until it is recreated with reset_database(), which drops its contents."
+      )
+
   async def generate_qa_pairs(
     self, input_text: str
   ) -> list[QAPair]:
@@ -102,7 +206,9 @@ class QAIndex:
     questions = [question] + rewordings
     questions = [q.strip() for q in questions]
     for i, q in enumerate(questions):
-      logger.trace(f"Reworded question {i+1}: {q}")
+      logger.trace(
+        "Reworded question {}: {}", i + 1, q
+      )
     return questions
 
   async def add_qa(
@@ -157,7 +263,7 @@ class QAIndex:
     ids = []
 
     for i, q in enumerate(questions):
-      logger.trace(f"Adding question: {q}")
+      logger.trace("Adding question: {}", q)
       documents.append(q)
       metadatas.append(metadata.copy())
       ids.append(f"qa_{self.collection.count()}_{i}")
@@ -167,9 +273,51 @@ class QAIndex:
       metadatas=metadatas,
       ids=ids,
     )
+    self._invalidate_query_cache()
 
     return set(questions)
 
+  def add_qa_pairs(
+    self,
+    qa_pairs: list[QAPair],
+    metadata: dict[str, Any] | None = None,
+  ) -> int:
+    """
+    Add a batch of question-answer pairs to the KB in
+    a single collection write.
+
+    Parameters
+    ----------
+    qa_pairs : list of QAPair
+        The question-answer pairs to index.
+    metadata : dict of {str: Any} or None, optional
+        Metadata shared by every pair. Default is None.
+
+    Returns
+    -------
+    int
+        The number of pairs indexed.
+    """
+    if not qa_pairs:
+      return 0
+
+    metadata = metadata or {}
+    base = self.collection.count()
+    self.collection.add(
+      documents=[qa_pair["q"] for qa_pair in qa_pairs],
+      metadatas=[
+        {**metadata, "answer": qa_pair["a"] or ""}
+        for qa_pair in qa_pairs
+      ],
+      ids=[
+        f"qa_{base + i}_0"
+        for i in range(len(qa_pairs))
+      ],
+    )
+    self._invalidate_query_cache()
+    logger.trace("Added {} QA pairs", len(qa_pairs))
+    return len(qa_pairs)
+
   async def query(
     self,
     question: str | list[str],
@@ -211,11 +359,75 @@ class QAIndex:
     else:
       questions = [question]
 
-    all_results = []
-    for q in questions:
-      logger.trace(f"Querying question: {q}")
+    all_results = [
+      result
+      for question_results in self._query_questions(
+        questions, n_results, metadata_filter
+      )
+      for result in question_results
+    ]
+
+    # Deduplicate results based on the answer
+    seen_answers = set()
+    unique_results = []
+    for result in all_results:
+      if result["answer"] not in seen_answers:
+        seen_answers.add(result["answer"])
+        unique_results.append(result)
+
+    # Select the top n_results by similarity without
+    # sorting all of the candidates
+    final_results = heapq.nlargest(
+      n_results,
+      unique_results,
+      key=lambda x: x["similarity"],
+    )
+    for i, result in enumerate(final_results):
+      logger.trace(
+        "Query result {}: {}", i + 1, result
+      )
+    return final_results
+
+  def _query_questions(
+    self,
+    questions: list[str],
+    n_results: int,
+    metadata_filter: Optional[dict[str, Any]],
+  ) -> list[list[dict[str, Any]]]:
+    filter_key = (
+      json.dumps(metadata_filter, sort_keys=True)
+      if metadata_filter
+      else None
+    )
+    keys = [
+      (q, n_results, filter_key) for q in questions
+    ]
+    results_by_key: dict[
+      tuple[str, int, str | None], list[dict[str, Any]]
+    ] = {}
+    with self.cache_lock:
+      for key in keys:
+        cached = self.query_cache.get(key)
+        if cached is not None:
+          self.query_cache.move_to_end(key)
+          results_by_key[key] = cached
+          logger.trace("Query cache hit: {}", key[0])
+      generation = self.query_cache_generation
+
+    # Look up every question that missed the cache with
+    # a single collection query
+    missing = [
+      key
+      for key in dict.fromkeys(keys)
+      if key not in results_by_key
+    ]
+    if missing:
+      for key in missing:
+        logger.trace("Querying question: {}", key[0])
       query_params = {
-        "query_texts": [q],
+        "query_embeddings": self._embed_questions(
+          [key[0] for key in missing]
+        ),
         "n_results": n_results,
         "include": [
           "documents",
@@ -229,12 +441,13 @@ class QAIndex:
 
       results = self.collection.query(**query_params)
 
-      for doc, metadata, distance in zip(
-        results["documents"][0],
-        results["metadatas"][0],
-        results["distances"][0],
+      for key, documents, metadatas, distances in zip(
+        missing,
+        results["documents"],
+        results["metadatas"],
+        results["distances"],
       ):
-        all_results.append(
+        results_by_key[key] = [
           {
             "question": doc,
             "answer": metadata["answer"],
@@ -245,25 +458,58 @@ class QAIndex:
             },
             "similarity": 1 - distance,
           }
-        )
-
-    # Deduplicate results based on the answer
-    seen_answers = set()
-    unique_results = []
-    for result in all_results:
-      if result["answer"] not in seen_answers:
-        seen_answers.add(result["answer"])
-        unique_results.append(result)
-
-    # Sort by similarity and return top n_results
-    final_results = sorted(
-      unique_results,
-      key=lambda x: x["similarity"],
-      reverse=True,
-    )[:n_results]
-    for i, result in enumerate(final_results):
-      logger.trace(f"Query result {i+1}: {result}")
-    return final_results
+          for doc, metadata, distance in zip(
+            documents, metadatas, distances
+          )
+        ]
+
+      # Don't cache results read before a concurrent
+      # write
+      with self.cache_lock:
+        if generation == self.query_cache_generation:
+          for key in missing:
+            self.query_cache[key] = results_by_key[key]
+          while (
+            len(self.query_cache)
+            > self.query_cache_size
+          ):
+            _ = self.query_cache.popitem(last=False)
+
+    return [results_by_key[key] for key in keys]
+
+  def _embed_questions(
+    self, questions: list[str]
+  ) -> list[Embedding]:
+    embeddings: dict[str, Embedding] = {}
+    with self.cache_lock:
+      for q in questions:
+        embedding = self.embedding_cache.get(q)
+        if embedding is not None:
+          self.embedding_cache.move_to_end(q)
+          embeddings[q] = embedding
+    missing = [
+      q
+      for q in dict.fromkeys(questions)
+      if q not in embeddings
+    ]
+    if missing:
+      embeddings.update(
+        zip(missing, self.embedding_function(missing))
+      )
+      with self.cache_lock:
+        for q in missing:
+          self.embedding_cache[q] = embeddings[q]
+        while (
+          len(self.embedding_cache)
+          > self.query_cache_size
+        ):
+          _ = self.embedding_cache.popitem(last=False)
+    return [embeddings[q] for q in questions]
+
+  def _invalidate_query_cache(self) -> None:
+    with self.cache_lock:
+      self.query_cache_generation += 1
+      self.query_cache.clear()
 
   def update_answer(
     self,
@@ -301,6 +547,7 @@ class QAIndex:
         documents=[question],
         metadatas=[metadata],
       )
+      self._invalidate_query_cache()
     else:
       raise ValueError("Question not found in KB")
     logger.info(
@@ -322,6 +569,7 @@ class QAIndex:
   def clear(self):
     if self.collection.count() > 0:
       self.collection.delete(where={})
+    self._invalidate_query_cache()
 
   def delete_where(
     self, where_filter: dict[str, Any]
@@ -332,6 +580,7 @@ class QAIndex:
     if not results["ids"]:
       return 0
     self.collection.delete(ids=results["ids"])
+    self._invalidate_query_cache()
     return len(results["ids"])
 
   def reset_database(self) -> None:
@@ -354,9 +603,11 @@ class QAIndex:
       )
 
     # Recreate the collection
-    self.collection = self.client.create_collection(
+    self._invalidate_query_cache()
+    self._collection = self.client.create_collection(
       name=self.collection_name,
       embedding_function=self.embedding_function,
+      metadata=self.collection_metadata,
     )
     logger.trace(
       f"Collection '{self.collection_name}' has been recreated."
@@ -66,6 +66,7 @@ running the application.
 """
 
 import ast
+import atexit
 import json
 import os
 import uuid
@@ -144,6 +145,8 @@ kms = KnowledgeManagementSystem(
   db_dir=DB_DIR,
   qa_collection_name=QA_COLLECTION_NAME,
 )
+# Finish background ingestion before exiting
+atexit.register(kms.close)
 
 #
 
@@ -486,7 +489,7 @@ async def handle_intent(
       ),
     ]
     response = await call_llm_and_tool(
-      messages=messages[:-1] + tmp_messages,
+      messages=tmp_messages,
       params=FUNCTION_CALL_RESPONSE_PROMPT.params,
       suppress_output=suppress_output,
     )
@@ -43,11 +43,11 @@ import json
 import os
 import sqlite3
 import threading
-from collections.abc import Iterable
-from concurrent.futures import ThreadPoolExecutor
+from collections.abc import Iterable, Sequence
+from concurrent.futures import Future, wait
 from dataclasses import dataclass, field
 from datetime import datetime
-from sqlite3 import Connection, Row, connect
+from sqlite3 import Connection
 from typing import Any, cast
 from uuid import UUID, uuid4
 
@@ -61,6 +61,7 @@ from ch04.kms import (
   IngestionReport,
   KnowledgeManagementSystem,
 )
+from ch05.memory_db import connect_memory_db
 
 #
 
@@ -82,7 +83,7 @@ class ConversationMessage(Message):
   metadata: dict[str, Any] | None
 
 
-@dataclass
+@dataclass(slots=True)
 class Conversation:
   id: UUID
   summary: str = ""
@@ -97,22 +98,49 @@ class ConversationalMemory:
     kms: KnowledgeManagementSystem,
     db_path: str,
     max_message_history: int = MAX_MESSAGE_HISTORY,
-    max_workers: int = 5,
   ):
     self.kms = kms
     self.db_path = db_path
     self.max_message_history = max_message_history
     self.local = threading.local()
-    self.executor = ThreadPoolExecutor(
-      max_workers=max_workers
+    # Background writes not yet stored, by conversation,
+    # and background tasks not yet finished, including
+    # KMS ingestion. Both are updated from the loop
+    # thread, hence the lock.
+    self.pending_writes: dict[
+      UUID, set[Future[None]]
+    ] = {}
+    self.pending_tasks: set[Future[Any]] = set()
+    self.pending_writes_lock = threading.Lock()
+    # A single long-lived event loop, run in a daemon
+    # thread, on which background writes are scheduled
+    self.loop = asyncio.new_event_loop()
+    self.loop_thread = threading.Thread(
+      target=self.loop.run_forever,
+      name="conversational-memory",
+      daemon=True,
     )
+    self.loop_thread.start()
     self._create_tables()
 
+  def close(self) -> None:
+    """
+    Wait for background writes to finish, then stop the
+    event loop they run on.
+    """
+    if self.loop.is_closed():
+      return
+    with self.pending_writes_lock:
+      pending = list(self.pending_tasks)
+    _ = wait(pending)
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.loop_thread.join()
+    self.loop.close()
+
   @property
   def conn(self) -> Connection:
     if not hasattr(self.local, "conn"):
-      self.local.conn = connect(self.db_path)
-      self.local.conn.row_factory = Row
+      self.local.conn = connect_memory_db(self.db_path)
     return self.local.conn
 
   def _create_tables(self) -> None:
@@ -152,54 +180,65 @@ class ConversationalMemory:
     message: ConversationMessage,
     bypass_ingestion: bool = False,
   ) -> IngestionReport | None:
-    # Update summary if necessary
-    #
-    # We must account for the system message and any
-    # previous summary that may have been added.
-    has_previous_summary = bool(
-      self.get_conversation_summary(conversation_id)
+    reports = await self.add_messages(
+      conversation_id, [message], bypass_ingestion
     )
-    message_offset = 1 + (
-      1 if has_previous_summary else 0
-    )
-    num_messages = len(
-      self.get_last_n_messages(conversation_id)
+    return reports[0] if reports else None
+
+  async def add_messages(
+    self,
+    conversation_id: UUID,
+    messages: Sequence[ConversationMessage],
+    bypass_ingestion: bool = False,
+  ) -> list[IngestionReport]:
+    """
+    Add several messages to a conversation, storing them
+    in a single transaction.
+
+    Parameters
+    ----------
+    conversation_id : UUID
+        The ID of the conversation to add the messages to.
+    messages : Sequence[ConversationMessage]
+        The messages to add, oldest first.
+    bypass_ingestion : bool, optional
+        If True, skip ingesting the messages into the KMS.
+
+    Returns
+    -------
+    list[IngestionReport]
+        The ingestion report of each message, empty if
+        ingestion was bypassed.
+    """
+    contents = await self._store_messages(
+      conversation_id, messages, bypass_ingestion
     )
-    # Don't include the system message and any previous
-    # summary in the message count
-    num_messages -= message_offset
-    if (
-      num_messages > 0
-      and num_messages % self.max_message_history == 0
-    ):
-      logger.info(
-        f"Updating summary for conversation {conversation_id}"
+    return await self._ingest_contents(contents)
+
+  async def _store_messages(
+    self,
+    conversation_id: UUID,
+    messages: Sequence[ConversationMessage],
+    bypass_ingestion: bool,
+  ) -> list[Content]:
+    """
+    Store messages in SQLite, returning the content to
+    ingest into the KMS.
+    """
+    rows: list[tuple[Any, ...]] = []
+    contents: list[Content] = []
+    for message in messages:
+      timestamp = (
+        message["timestamp"].isoformat()
+        if "timestamp" in message
+        else datetime.now().isoformat()
       )
-      _ = await self.summarize_messages(
-        conversation_id=conversation_id,
-        messages=self.get_last_n_messages(
-          conversation_id,
-          n=self.max_message_history,
-        ),
-        previous_summary=self.get_conversation_summary(
-          conversation_id
-        ),
+      metadata_json = (
+        json.dumps(message["metadata"])
+        if "metadata" in message
+        else None
       )
-
-    # Store the message in SQLite
-    timestamp = (
-      message["timestamp"].isoformat()
-      if "timestamp" in message
-      else datetime.now().isoformat()
-    )
-    metadata_json = (
-      json.dumps(message["metadata"])
-      if "metadata" in message
-      else None
-    )
-    with self.conn:
-      self.conn.execute(
-        "INSERT INTO messages (id, conversation_id, role, content, metadata, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+      rows.append(
         (
           str(message["id"]),
           str(conversation_id),
@@ -207,32 +246,92 @@ class ConversationalMemory:
           message["content"],
           metadata_json,
           timestamp,
-        ),
+        )
+      )
+      if bypass_ingestion:
+        continue
+
+      metadata_dict = cast(
+        dict[str, Any],
+        message["metadata"]
+        if "metadata" in message
+        else {},
+      )
+      contents.append(
+        Content(
+          id=str(message["id"]),
+          type="message",
+          content=message["content"],
+          metadata={
+            "conversation_id": str(
+              message["conversation_id"]
+            ),
+            "role": message["role"],
+            "timestamp": timestamp,
+            **metadata_dict,
+          },
+        )
       )
-    if bypass_ingestion:
-      return None
 
-    # Index the message in KMS
-    metadata_dict = cast(
-      dict[str, Any],
-      message["metadata"]
-      if "metadata" in message
-      else {},
-    )
-    content = Content(
-      id=str(message["id"]),
-      type="message",
-      content=message["content"],
-      metadata={
-        "conversation_id": str(
-          message["conversation_id"]
-        ),
-        "role": message["role"],
-        "timestamp": timestamp,
-        **metadata_dict,
-      },
+    # Store the messages in SQLite, in one transaction
+    # unless a summary falls due part way through. The
+    # summary check runs before each message, as if the
+    # messages were added one at a time, and sees the
+    # messages of the batch inserted so far.
+    try:
+      for row in rows:
+        if self._summary_due(conversation_id):
+          # Don't hold the write lock during the LLM call
+          self.conn.commit()
+          logger.info(
+            f"Updating summary for conversation {conversation_id}"
+          )
+          _ = await self.summarize_messages(
+            conversation_id=conversation_id,
+            messages=self.get_last_n_messages(
+              conversation_id,
+              n=self.max_message_history,
+            ),
+            previous_summary=self.get_conversation_summary(
+              conversation_id
+            ),
+          )
+        _ = self.conn.execute(
+          "INSERT INTO messages (id, conversation_id, role, content, metadata, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+          row,
+        )
+      self.conn.commit()
+    except BaseException:
+      self.conn.rollback()
+      raise
+    return contents
+
+  async def _ingest_contents(
+    self, contents: Iterable[Content]
+  ) -> list[IngestionReport]:
+    # Index the messages in KMS
+    return [
+      await self.kms.ingest_content(content)
+      for content in contents
+    ]
+
+  def _summary_due(
+    self, conversation_id: UUID
+  ) -> bool:
+    # The summary is refreshed every max_message_history
+    # messages. Count every stored message except the
+    # system message: the history window is capped, so
+    # its size can't be used as the running count.
+    # A plain read, so that it doesn't commit the
+    # transaction add_messages has open.
+    (num_messages,) = self.conn.execute(
+      "SELECT COUNT(*) FROM messages WHERE conversation_id = ? AND role != 'system'",
+      (str(conversation_id),),
+    ).fetchone()
+    return (
+      num_messages > 0
+      and num_messages % self.max_message_history == 0
     )
-    return await self.kms.ingest_content(content)
 
   def get_last_n_messages(
     self,
@@ -241,30 +340,16 @@ class ConversationalMemory:
   ) -> list[ConversationMessage]:
     messages: list[ConversationMessage] = []
 
-    if n is None:
-      n = self.max_message_history
-
-    # Get the system message
-    with self.conn:
-      system_message = self.conn.execute(
-        "SELECT * FROM messages WHERE conversation_id = ? AND role = 'system' ORDER BY timestamp ASC LIMIT 1",
-        (str(conversation_id),),
-      ).fetchone()
+    system_message, results, include_summary = (
+      self._select_last_n(conversation_id, n, "*")
+    )
 
     if system_message:
       messages.append(
         self._row_to_message(system_message)
       )
 
-    # Get the last n messages
-    with self.conn:
-      results = self.conn.execute(
-        "SELECT * FROM messages WHERE conversation_id = ? AND role != 'system' ORDER BY timestamp DESC LIMIT ?",
-        (str(conversation_id), n),
-      ).fetchall()
-
-    # Inject a summary if we have more than n messages
-    if len(results) == n:
+    if include_summary:
       summary = self.get_conversation_summary(
         conversation_id
       )
@@ -281,12 +366,81 @@ class ConversationalMemory:
       )
       messages.append(summary_message)
 
-    # Add the last n messages in reverse order (oldest first)
-    for row in reversed(results):
+    for row in results:
       messages.append(self._row_to_message(row))
 
     return messages
 
+  def get_last_n_history(
+    self,
+    conversation_id: UUID,
+    n: int | None = None,
+  ) -> list[Message]:
+    """
+    Get the messages `get_last_n_messages` would return,
+    reduced to the role and content needed to prompt an
+    LLM and built straight from the selected columns.
+    """
+    system_message, results, include_summary = (
+      self._select_last_n(
+        conversation_id, n, "role, content"
+      )
+    )
+
+    messages: list[Message] = []
+    if system_message:
+      messages.append(
+        cast(Message, dict(system_message))
+      )
+
+    if include_summary:
+      summary = self.get_conversation_summary(
+        conversation_id
+      )
+      messages.append(
+        Message(
+          role="assistant",
+          content=f"Summary of conversation so far:\n\n{summary}",
+        )
+      )
+
+    messages.extend(
+      cast(Message, dict(row)) for row in results
+    )
+    return messages
+
+  def _select_last_n(
+    self,
+    conversation_id: UUID,
+    n: int | None,
+    columns: str,
+  ) -> tuple[
+    sqlite3.Row | None, list[sqlite3.Row], bool
+  ]:
+    """
+    Select the window of messages shown to the LLM: the
+    system message and the last n other messages, oldest
+    first. Once the window is full, a summary of the
+    earlier messages is shown before them, as flagged
+    by the last element of the returned tuple.
+    """
+    if n is None:
+      n = self.max_message_history
+
+    # Plain reads, so that they don't commit the
+    # transaction add_messages has open
+    system_message = self.conn.execute(
+      f"SELECT {columns} FROM messages WHERE conversation_id = ? AND role = 'system' ORDER BY timestamp ASC LIMIT 1",
+      (str(conversation_id),),
+    ).fetchone()
+    results = self.conn.execute(
+      f"SELECT {columns} FROM messages WHERE conversation_id = ? AND role != 'system' ORDER BY timestamp DESC LIMIT ?",
+      (str(conversation_id), n),
+    ).fetchall()
+
+    results.reverse()
+    return system_message, results, len(results) == n
+
   def _row_to_message(
     self, row: sqlite3.Row
   ) -> ConversationMessage:
@@ -378,11 +532,12 @@ class ConversationalMemory:
     self,
     conversation_id: UUID,
   ) -> str:
-    with self.conn:
-      result = self.conn.execute(
-        "SELECT summary FROM conversations WHERE id = ?",
-        (str(conversation_id),),
-      ).fetchone()
+    # A plain read, so that it doesn't commit the
+    # transaction add_messages has open
+    result = self.conn.execute(
+      "SELECT summary FROM conversations WHERE id = ?",
+      (str(conversation_id),),
+    ).fetchone()
 
     if result:
       return result[0]
@@ -521,40 +676,106 @@ class ConversationalMemory:
     bypass_ingestion : bool, optional
         If True, skip ingesting the message into the KMS.
     """
-    self.executor.submit(
-      self._add_message_background,
-      conversation_id,
-      message,
-      bypass_ingestion,
+    # Resolved once the message is committed, before
+    # the slower KMS ingestion
+    stored: Future[None] = Future()
+    with self.pending_writes_lock:
+      self.pending_writes.setdefault(
+        conversation_id, set()
+      ).add(stored)
+    stored.add_done_callback(
+      lambda stored: self._finish_background_write(
+        conversation_id, stored
+      )
+    )
+    task = asyncio.run_coroutine_threadsafe(
+      self._add_message_in_background(
+        conversation_id,
+        message,
+        bypass_ingestion,
+        stored,
+      ),
+      self.loop,
+    )
+    with self.pending_writes_lock:
+      self.pending_tasks.add(task)
+    task.add_done_callback(
+      lambda task: self._finish_background_task(
+        task, stored
+      )
     )
 
-  def _add_message_background(
+  async def _add_message_in_background(
     self,
     conversation_id: UUID,
     message: ConversationMessage,
     bypass_ingestion: bool,
-  ) -> None:
-    thread_name = threading.current_thread().name
-    logger.info(
-      f"Background add_message task started in thread: {thread_name}"
-    )
+    stored: Future[None],
+  ) -> list[IngestionReport]:
     try:
-      loop = asyncio.new_event_loop()
-      asyncio.set_event_loop(loop)
-      loop.run_until_complete(
-        self.add_message(
-          conversation_id, message, bypass_ingestion
-        )
+      contents = await self._store_messages(
+        conversation_id, [message], bypass_ingestion
+      )
+    except BaseException as e:
+      stored.set_exception(e)
+      raise
+    stored.set_result(None)
+    return await self._ingest_contents(contents)
+
+  async def wait_for_background_writes(
+    self, conversation_id: UUID
+  ) -> None:
+    """
+    Wait until the background writes submitted so far
+    for a conversation have been stored. Their KMS
+    ingestion may still be running.
+
+    Parameters
+    ----------
+    conversation_id : UUID
+        The ID of the conversation.
+    """
+    with self.pending_writes_lock:
+      futures = list(
+        self.pending_writes.get(conversation_id, ())
       )
-      loop.close()
-      logger.info(
-        f"Message added successfully in thread: {thread_name}"
+    if futures:
+      _ = await asyncio.gather(
+        *(asyncio.wrap_future(f) for f in futures),
+        return_exceptions=True,
       )
-    except Exception as e:
-      logger.exception(
-        f"Error in background add_message task: {e}"
+
+  def _finish_background_write(
+    self, conversation_id: UUID, stored: Future[None]
+  ) -> None:
+    with self.pending_writes_lock:
+      futures = self.pending_writes.get(
+        conversation_id, set()
       )
-    finally:
-      logger.info(
-        f"Background add_message task completed in thread: {thread_name}"
+      futures.discard(stored)
+      if not futures:
+        _ = self.pending_writes.pop(
+          conversation_id, None
+        )
+
+  def _finish_background_task(
+    self, task: Future[Any], stored: Future[None]
+  ) -> None:
+    # A task cancelled before it ran never stored its
+    # messages, so don't leave waiters hanging
+    _ = stored.cancel()
+    with self.pending_writes_lock:
+      self.pending_tasks.discard(task)
+    self._log_background_error(task)
+
+  @staticmethod
+  def _log_background_error(
+    future: Future[Any],
+  ) -> None:
+    if future.cancelled():
+      return
+    exception = future.exception()
+    if exception:
+      logger.opt(exception=exception).error(
+        f"Error in background add_messages task: {exception}"
       )
@@ -4,10 +4,15 @@ Episodic memory
 """
 
 import json
+import os
 import sqlite3
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import TypedDict
-from uuid import uuid4
+from uuid import UUID, uuid4
+
+from dotenv import load_dotenv
+from loguru import logger
 
 from ch03.llm import Message
 from ch03.prompt import load_prompt
@@ -20,9 +25,16 @@ from ch05.conversational_memory import (
   ConversationalMemory,
   ConversationMessage,
 )
+from ch05.memory_db import connect_memory_db
 
 #
 
+_ = load_dotenv()
+
+MAX_ACTIVE_CONVERSATIONS = int(
+  os.getenv("MAX_ACTIVE_CONVERSATIONS", "512")
+)
+
 EPISODE_BOUNDARY_DETECTION_PROMPT = load_prompt(
   "ch05/memory/episode_boundary_detection"
 )
@@ -39,13 +51,13 @@ class EpisodeBoundaryDetection(TypedDict):
   rationale: str
 
 
-@dataclass
+@dataclass(slots=True)
 class EpisodeReport:
   boundary_detection: EpisodeBoundaryDetection
   reflection: str | None = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Episode:
   id: str
   conversation_id: str
@@ -65,21 +77,28 @@ class Episode:
 
 
 class EpisodicMemory:
-  first_episode_message: ConversationMessage | None
+  # The first message of the current episode of each
+  # active conversation, least recently used first
+  first_episode_messages: OrderedDict[
+    UUID, ConversationMessage
+  ]
 
   def __init__(
     self,
     kms: KnowledgeManagementSystem,
     cm: ConversationalMemory,
     db_path: str,
+    max_active_conversations: int = MAX_ACTIVE_CONVERSATIONS,
   ):
     self.kms = kms
     self.cm = cm
     self.db_path = db_path
-    self.conn = sqlite3.connect(db_path)
-    self.conn.row_factory = sqlite3.Row
+    self.max_active_conversations = (
+      max_active_conversations
+    )
+    self.conn = connect_memory_db(db_path)
     self._create_tables()
-    self.first_episode_message = None
+    self.first_episode_messages = OrderedDict()
 
   def _create_tables(self) -> None:
     with self.conn:
@@ -121,7 +140,8 @@ class EpisodicMemory:
 
     Notes
     -----
-    This method performs the following steps:
+    This method runs `detect_episode_boundary` followed
+    by `finalize_episode`, which perform these steps:
     1. Handles the first message of a conversation if applicable.
     2. Detects if the new message starts a new episode.
     3. If a new episode is detected:
@@ -131,29 +151,109 @@ class EpisodicMemory:
        - Updates the first message of the new episode.
     4. Returns a report with boundary detection and reflection (if applicable).
     """
-    if self.first_episode_message is None:
-      return self._handle_first_message(user_message)
-
     boundary_detection = (
-      await self._detect_episode_boundary(
-        history, whiteboard
+      await self.detect_episode_boundary(
+        user_message, history, whiteboard
+      )
+    )
+    return await self.finalize_episode(
+      user_message, boundary_detection, whiteboard
+    )
+
+  async def detect_episode_boundary(
+    self,
+    user_message: ConversationMessage,
+    history: list[Message],
+    whiteboard: str,
+  ) -> EpisodeBoundaryDetection:
+    """
+    Detect if a new user message starts a new episode.
+
+    The detection does not change any state, so it can
+    run on the whiteboard from before the message while
+    the whiteboard is being updated.
+
+    Parameters
+    ----------
+    user_message : ConversationMessage
+        The latest message from the user.
+    history : list[Message]
+        The conversation history.
+    whiteboard : str
+        The state of the whiteboard.
+
+    Returns
+    -------
+    EpisodeBoundaryDetection
+        Whether a new episode starts, and why.
+    """
+    if (
+      user_message["conversation_id"]
+      not in self.first_episode_messages
+    ):
+      return EpisodeBoundaryDetection(
+        is_new_episode=True,
+        rationale="This is the first message in the conversation",
+      )
+    return await self._detect_episode_boundary(
+      history, whiteboard
+    )
+
+  async def finalize_episode(
+    self,
+    user_message: ConversationMessage,
+    boundary_detection: EpisodeBoundaryDetection,
+    whiteboard: str,
+  ) -> EpisodeReport:
+    """
+    Close the current episode if a boundary was detected
+    and generate a report.
+
+    Parameters
+    ----------
+    user_message : ConversationMessage
+        The latest message from the user.
+    boundary_detection : EpisodeBoundaryDetection
+        The result of `detect_episode_boundary`.
+    whiteboard : str
+        The current state of the whiteboard, used for the
+        episode reflection.
+
+    Returns
+    -------
+    EpisodeReport
+        A report containing boundary detection results and, if applicable, episode reflection.
+    """
+    first_episode_message = (
+      self.first_episode_messages.get(
+        user_message["conversation_id"]
       )
     )
+    if first_episode_message is None:
+      self._set_first_episode_message(user_message)
+      return EpisodeReport(
+        boundary_detection=boundary_detection
+      )
+    self.first_episode_messages.move_to_end(
+      user_message["conversation_id"]
+    )
 
     if not boundary_detection["is_new_episode"]:
       return EpisodeReport(
         boundary_detection=boundary_detection
       )
 
-    episode_messages = self._get_episode_messages()
+    episode_messages = self._get_episode_messages(
+      first_episode_message
+    )
     reflection = await self._create_reflection(
       episode_messages, whiteboard
     )
     await self._store_and_index_episode(
-      user_message, reflection
+      first_episode_message, user_message, reflection
     )
 
-    self.first_episode_message = user_message
+    self._set_first_episode_message(user_message)
 
     return EpisodeReport(
       boundary_detection=boundary_detection,
@@ -223,26 +323,58 @@ class EpisodicMemory:
     )
 
     # Convert related content to episodes, excluding the original episode
-    related_episodes: list[Episode] = []
-    for content in related_content:
-      if content.id != episode_id:
-        related_episode = self.get_episode(content.id)
-        if related_episode:
-          related_episodes.append(related_episode)
+    related_ids = [
+      content.id
+      for content in related_content
+      if content.id != episode_id
+    ]
+    if not related_ids:
+      return []
 
-    return related_episodes
+    # Resolve all of the related episodes in a single
+    # query rather than one lookup per result
+    placeholders = ", ".join("?" for _ in related_ids)
+    with self.conn:
+      cursor = self.conn.execute(
+        f"SELECT * FROM episodes WHERE id IN ({placeholders})",
+        related_ids,
+      )
+      episodes_by_id = {
+        row["id"]: Episode.from_db_row(row)
+        for row in cursor.fetchall()
+      }
+
+    # Preserve the relevance ordering of the results
+    return [
+      episodes_by_id[id]
+      for id in related_ids
+      if id in episodes_by_id
+    ]
 
-  def _handle_first_message(
+  def _set_first_episode_message(
     self,
     user_message: ConversationMessage,
-  ) -> EpisodeReport:
-    self.first_episode_message = user_message
-    return EpisodeReport(
-      boundary_detection=EpisodeBoundaryDetection(
-        is_new_episode=True,
-        rationale="This is the first message in the conversation",
-      ),
+  ) -> None:
+    conversation_id = user_message["conversation_id"]
+    self.first_episode_messages[conversation_id] = (
+      user_message
     )
+    self.first_episode_messages.move_to_end(
+      conversation_id
+    )
+    # Forget the least recently active conversations;
+    # their next message starts a new episode
+    while (
+      len(self.first_episode_messages)
+      > self.max_active_conversations
+    ):
+      evicted_id, _ = (
+        self.first_episode_messages.popitem(last=False)
+      )
+      logger.debug(
+        "Evicted episode state for conversation {}",
+        evicted_id,
+      )
 
   async def _detect_episode_boundary(
     self,
@@ -259,15 +391,13 @@ class EpisodicMemory:
 
   def _get_episode_messages(
     self,
+    first_episode_message: ConversationMessage,
   ) -> list[ConversationMessage]:
-    assert self.first_episode_message is not None
     return self.cm.get_messages_since(
-      conversation_id=self.first_episode_message[
+      conversation_id=first_episode_message[
         "conversation_id"
       ],
-      since_message_id=self.first_episode_message[
-        "id"
-      ],
+      since_message_id=first_episode_message["id"],
     )
 
   async def _create_reflection(
@@ -292,10 +422,10 @@ class EpisodicMemory:
 
   async def _store_and_index_episode(
     self,
+    first_episode_message: ConversationMessage,
     user_message: ConversationMessage,
     reflection: str,
   ) -> None:
-    assert self.first_episode_message is not None
     episode_id = str(uuid4())
     with self.conn:
       self.conn.execute(
@@ -307,11 +437,9 @@ class EpisodicMemory:
         (
           episode_id,
           str(
-            self.first_episode_message[
-              "conversation_id"
-            ]
+            first_episode_message["conversation_id"]
           ),
-          str(self.first_episode_message["id"]),
+          str(first_episode_message["id"]),
           str(user_message["id"]),
           reflection,
         ),
@@ -323,7 +451,7 @@ class EpisodicMemory:
       content=reflection,
       metadata={
         "conversation_id": str(
-          self.first_episode_message["conversation_id"]
+          first_episode_message["conversation_id"]
         ),
       },
     )
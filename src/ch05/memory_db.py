@@ -0,0 +1,50 @@
+# src/ch05/memory_db.py
+"""
+SQLite connections for the memory database
+
+The conversational memory, whiteboard and episodic
+memory all share a single SQLite database. This module
+opens connections to it with the settings tuned for a
+mix of foreground reads and background writes.
+"""
+
+import sqlite3
+
+#
+
+# Pragmas applied to every connection. Write-ahead
+# logging lets readers proceed while a background
+# writer commits, and is persisted in the database
+# file, so it is a no-op after the first connection.
+MEMORY_DB_PRAGMAS = (
+  "PRAGMA journal_mode=WAL",
+  "PRAGMA synchronous=NORMAL",
+  "PRAGMA cache_size=-64000",
+  "PRAGMA temp_store=MEMORY",
+  "PRAGMA busy_timeout=5000",
+  "PRAGMA wal_autocheckpoint=1000",
+)
+
+
+def connect_memory_db(
+  db_path: str,
+) -> sqlite3.Connection:
+  """
+  Open a connection to the memory database.
+
+  Parameters
+  ----------
+  db_path : str
+      The path to the SQLite database file.
+
+  Returns
+  -------
+  sqlite3.Connection
+      The configured connection, returning rows as
+      `sqlite3.Row`.
+  """
+  conn = sqlite3.connect(db_path)
+  conn.row_factory = sqlite3.Row
+  for pragma in MEMORY_DB_PRAGMAS:
+    _ = conn.execute(pragma)
+  return conn
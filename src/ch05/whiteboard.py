@@ -4,7 +4,7 @@ Short-term memory Whiteboard
 """
 
 import os
-import sqlite3
+from collections import OrderedDict
 from collections.abc import Iterable
 from typing import Any, cast
 from uuid import UUID
@@ -13,12 +13,16 @@ from dotenv import load_dotenv
 
 from ch03.llm import Message, call_llm
 from ch03.prompt import load_prompt
+from ch05.memory_db import connect_memory_db
 
 #
 
 _ = load_dotenv()
 
 PROMPT_DIR = os.getenv("PROMPT_DIR", "prompts")
+MAX_ACTIVE_CONVERSATIONS = int(
+  os.getenv("MAX_ACTIVE_CONVERSATIONS", "512")
+)
 
 UPDATE_WHITEBOARD_PROMPT = load_prompt(
   "ch05/memory/update_whiteboard"
@@ -36,13 +40,20 @@ with open(
 
 
 class Whiteboard:
+  # A write-through cache of the state of the most
+  # recently active conversations, least recently used
+  # first
+  states: OrderedDict[UUID, str]
+
   def __init__(
     self,
     db_path: str,
+    max_cached_states: int = MAX_ACTIVE_CONVERSATIONS,
   ):
     self.db_path = db_path
-    self.conn = sqlite3.connect(db_path)
-    self.conn.row_factory = sqlite3.Row
+    self.max_cached_states = max_cached_states
+    self.states = OrderedDict()
+    self.conn = connect_memory_db(db_path)
     self._create_table()
 
   def _create_table(self):
@@ -58,6 +69,11 @@ class Whiteboard:
     self,
     conversation_id: UUID,
   ) -> str:
+    state = self.states.get(conversation_id)
+    if state is not None:
+      self.states.move_to_end(conversation_id)
+      return state
+
     with self.conn:
       result = self.conn.execute(
         "SELECT state FROM whiteboard WHERE conversation_id = ?",
@@ -65,6 +81,9 @@ class Whiteboard:
       ).fetchone()
 
     if result:
+      self._cache_state(
+        conversation_id, result["state"]
+      )
       return result["state"]
     else:
       # Initialize with template if not exists
@@ -83,6 +102,18 @@ class Whiteboard:
         "INSERT OR REPLACE INTO whiteboard (conversation_id, state) VALUES (?, ?)",
         (str(conversation_id), state),
       )
+    self._cache_state(conversation_id, state)
+
+  def _cache_state(
+    self,
+    conversation_id: UUID,
+    state: str,
+  ) -> None:
+    self.states[conversation_id] = state
+    self.states.move_to_end(conversation_id)
+    # Evicted states are still in the database
+    while len(self.states) > self.max_cached_states:
+      _ = self.states.popitem(last=False)
 
   async def update_whiteboard(
     self,
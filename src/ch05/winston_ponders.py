@@ -73,6 +73,7 @@ running the application.
 """
 
 import ast
+import atexit
 import json
 import os
 import sys
@@ -162,10 +163,14 @@ kms = KnowledgeManagementSystem(
   db_dir=DB_DIR,
   qa_collection_name=QA_COLLECTION_NAME,
 )
+# Finish background ingestion before exiting
+atexit.register(kms.close)
 cm = ConversationalMemory(
   kms=kms,
   db_path=MEMORY_DB_PATH,
 )
+# Registered after kms.close, so that it runs first
+atexit.register(cm.close)
 wb = Whiteboard(
   db_path=MEMORY_DB_PATH,
 )
@@ -605,7 +610,7 @@ async def handle_intent(
       ),
     ]
     response = await call_llm_and_tool(
-      messages=messages[:-1] + tmp_messages,
+      messages=tmp_messages,
       params=FUNCTION_CALL_RESPONSE_PROMPT.params,
       suppress_output=suppress_output,
     )
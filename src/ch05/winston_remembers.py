@@ -73,11 +73,16 @@ running the application.
 """
 
 import ast
+import asyncio
+import atexit
 import json
 import os
 import sys
 from dataclasses import asdict
 from datetime import datetime
+from functools import lru_cache
+from statistics import fmean
+from types import MappingProxyType
 from typing import Any, cast
 from uuid import UUID, uuid4
 
@@ -159,14 +164,39 @@ MULTI_INTENT_PROMPT = load_prompt(
 
 #
 
+
+# The whiteboard often stays the same across turns and
+# there are only a few greetings, so memoize the renders
+@lru_cache(maxsize=64)
+def render_winston_prompt(whiteboard: str) -> str:
+  """Render the system prompt for a whiteboard state"""
+  return WINSTON_PROMPT.render(whiteboard=whiteboard)
+
+
+@lru_cache(maxsize=8)
+def render_greeting_prompt(
+  user_name: str, time_of_day: str
+) -> str:
+  """Render the greeting for a user and time of day"""
+  return GREETING_PROMPT.render(
+    user_name=user_name, time_of_day=time_of_day
+  )
+
+
+#
+
 kms = KnowledgeManagementSystem(
   db_dir=DB_DIR,
   qa_collection_name=QA_COLLECTION_NAME,
 )
+# Finish background ingestion before exiting
+atexit.register(kms.close)
 cm = ConversationalMemory(
   kms=kms,
   db_path=MEMORY_DB_PATH,
 )
+# Registered after kms.close, so that it runs first
+atexit.register(cm.close)
 wb = Whiteboard(
   db_path=MEMORY_DB_PATH,
 )
@@ -196,6 +226,33 @@ def get_current_weather(
   return json.dumps(weather_info)
 
 
+# The tool schema offered to the LLM for the weather
+# intent
+WEATHER_TOOLS = [
+  {
+    "type": "function",
+    "function": {
+      "name": "get_current_weather",
+      "description": "Get the current weather in a given location",
+      "parameters": {
+        "type": "object",
+        "properties": {
+          "location": {
+            "type": "string",
+            "description": "The city and state, e.g. San Francisco, CA",
+          },
+          "unit": {
+            "type": "string",
+            "enum": ["celsius", "fahrenheit"],
+          },
+        },
+        "required": ["location"],
+      },
+    },
+  }
+]
+
+
 async def call_llm_and_tool(
   messages: list[Message],
   params: LLMParams | None = None,
@@ -233,7 +290,9 @@ async def call_llm_and_tool(
     )
 
     ui_msg = None
-    function_msg: Message | None = None
+    tool_calls: list[
+      ChatCompletionMessageToolCall
+    ] = []
     async for chunk in response_generator:
       if chunk["type"] == "token":
         if not ui_msg:
@@ -241,14 +300,25 @@ async def call_llm_and_tool(
           _ = await ui_msg.send()
         await ui_msg.stream_token(chunk["data"])
       elif chunk["type"] == "tool_call" and tools:
-        tool_call = cast(
-          ChatCompletionMessageToolCall,
-          chunk["data"],
-        )
-        function_msg = await call_tool(
-          tool_call.function
+        tool_calls.append(
+          cast(
+            ChatCompletionMessageToolCall,
+            chunk["data"],
+          )
         )
 
+    # Execute the selected tools concurrently; as
+    # before, the last tool's result is the response
+    function_msgs = await asyncio.gather(
+      *(
+        call_tool(tool_call.function)
+        for tool_call in tool_calls
+      )
+    )
+    function_msg = (
+      function_msgs[-1] if function_msgs else None
+    )
+
     if not function_msg and ui_msg:
       await ui_msg.update()
     return function_msg or (
@@ -292,7 +362,12 @@ async def call_tool(
   if not function_name:
     raise ValueError("Function name is required")
 
-  arguments = ast.literal_eval(function.arguments)
+  # Tool arguments are JSON; only fall back to parsing
+  # them as a Python literal if the model strays
+  try:
+    arguments = json.loads(function.arguments)
+  except json.JSONDecodeError:
+    arguments = ast.literal_eval(function.arguments)
 
   current_step = cl.context.current_step
   if not current_step:
@@ -341,9 +416,7 @@ async def start_chat() -> None:
     Message,
     {
       "role": "system",
-      "content": WINSTON_PROMPT.render(
-        whiteboard=initial_state,
-      ),
+      "content": render_winston_prompt(initial_state),
     },
   )
   await cm.add_message(
@@ -363,8 +436,8 @@ async def start_chat() -> None:
     Message,
     {
       "role": "user",
-      "content": GREETING_PROMPT.render(
-        user_name=USER_NAME, time_of_day=time_of_day
+      "content": render_greeting_prompt(
+        USER_NAME, time_of_day
       ),
     },
   )
@@ -408,7 +481,9 @@ async def handle_message(message: cl.Message) -> None:
   )
   assert isinstance(conversation_id, UUID)
 
-  # Add user message to conversational memory
+  # Messages are stored in the background, so stamp
+  # them when they are created to keep the history in
+  # arrival order
   user_message = cast(
     ConversationMessage,
     {
@@ -416,26 +491,22 @@ async def handle_message(message: cl.Message) -> None:
       "conversation_id": conversation_id,
       "role": "user",
       "content": message.content,
+      "timestamp": datetime.now(),
     },
   )
+
+  # Retrieve conversation history, once the previous
+  # turn has been stored
+  await cm.wait_for_background_writes(conversation_id)
+  history = cm.get_last_n_history(
+    conversation_id=conversation_id,
+  )
+  # Store the user message now that the history has
+  # been read, so that it isn't listed twice
   cm.add_message_background(
     conversation_id=conversation_id,
     message=user_message,
   )
-
-  # Retrieve conversation history
-  history = [
-    cast(
-      Message,
-      {
-        "role": cm["role"],
-        "content": cm["content"],
-      },
-    )
-    for cm in cm.get_last_n_messages(
-      conversation_id=conversation_id,
-    )
-  ]
   # Add the current user message to the history
   history.append(
     Message(
@@ -444,35 +515,47 @@ async def handle_message(message: cl.Message) -> None:
     )
   )
 
-  # Classify user intent
-  intents = await classify_intent(
-    messages=history,
-    prompt=MULTI_INTENT_PROMPT,
+  # Classify user intent, get relevant information from
+  # the KMS and retrieve relevant episodic memories
+  # concurrently, since they are independent
+  (
+    intents,
+    retrieved_content,
+    relevant_episode_content,
+  ) = await asyncio.gather(
+    classify_intent(
+      messages=history,
+      prompt=MULTI_INTENT_PROMPT,
+    ),
+    kms.retrieve_content(str(user_message["content"])),
+    em.query_episodes(message.content, n_results=3),
   )
   context: dict[str, Any] = {"intents": intents}
-
-  # Get relevant information from the KMS
-  retrieved_content = await kms.retrieve_content(
-    str(user_message["content"])
-  )
   context["relevant_content"] = [
     content.content for content in retrieved_content
   ]
-
-  # Retrieve relevant episodic memories
-  relevant_episode_content = await em.query_episodes(
-    message.content, n_results=3
-  )
   context["relevant_episodes"] = [
     content.content
     for content in relevant_episode_content
   ]
 
-  # Update the whiteboard with the new context
-  updated_whiteboard = await wb.update_whiteboard(
-    conversation_id=conversation_id,
-    messages=history,
-    context=context,
+  # Update the whiteboard with the new context. Episode
+  # boundary detection only needs the previous
+  # whiteboard, so run it at the same time.
+  (
+    updated_whiteboard,
+    boundary_detection,
+  ) = await asyncio.gather(
+    wb.update_whiteboard(
+      conversation_id=conversation_id,
+      messages=history,
+      context=context,
+    ),
+    em.detect_episode_boundary(
+      user_message=user_message,
+      history=history,
+      whiteboard=wb.get_state(conversation_id),
+    ),
   )
   # Create a Chainlit Step to display the ingestion report
   async with cl.Step(name="Short-Term Memory") as step:
@@ -480,9 +563,9 @@ async def handle_message(message: cl.Message) -> None:
     step.language = "text"
 
   # Process episodic memory
-  episode_report = await em.process_episode(
+  episode_report = await em.finalize_episode(
     user_message=user_message,
-    history=history,
+    boundary_detection=boundary_detection,
     whiteboard=updated_whiteboard,
   )
   # Create a Chainlit Step to display the ingestion report
@@ -510,14 +593,14 @@ async def handle_message(message: cl.Message) -> None:
     Message,
     {
       "role": "system",
-      "content": WINSTON_PROMPT.render(
-        whiteboard=updated_whiteboard,
+      "content": render_winston_prompt(
+        updated_whiteboard
       ),
     },
   )
 
   # Update the history with the new system message
-  history = [updated_system_message] + history[1:]
+  history[0] = updated_system_message
 
   system_message = cm.get_system_message(
     conversation_id
@@ -533,49 +616,18 @@ async def handle_message(message: cl.Message) -> None:
     )
 
   # Handle the user intent
-  intent_handlers = {
-    "weather": handle_weather_intent,
-    "task": handle_task_intent,
-    "help": handle_help_intent,
-    "general": handle_general_intent,
-    "remember": handle_remember_intent,
-    "question": handle_question_intent,
-  }
-
-  all_responses: list[Message] = []
-  for intent in intents:
-    handler = intent_handlers.get(
-      intent, handle_general_intent
+  if len(intents) == 1:
+    # A single intent streams its own response and
+    # needs no synthesis
+    handler = INTENT_HANDLERS.get(
+      intents[0], handle_general_intent
     )
-    intent_messages = await handler(
-      messages=history,
-      suppress_output=len(intents) > 1,
-    )
-    all_responses.extend(intent_messages)
-
-  if len(all_responses) > 1:
-    final_prompt = (
-      MULTI_INTENT_SYNTHESIS_PROMPT.render(
-        previous_responses="\n".join(
-          [
-            str(m["content"])
-            for m in all_responses
-            if m["role"] == "assistant"
-          ]
-        )
-      )
-    )
-    final_message = cast(
-      Message,
-      {"role": "user", "content": final_prompt},
-    )
-    final_response = await call_llm_and_tool(
-      messages=history + [final_message],
-      params=MULTI_INTENT_SYNTHESIS_PROMPT.params,
-    )
-    assert isinstance(final_response, str)
+    intent_messages = await handler(messages=history)
+    final_response = intent_messages[0]["content"]
   else:
-    final_response = all_responses[0]["content"]
+    final_response = await handle_multiple_intents(
+      intents, history
+    )
 
   final_assistant_message = cast(
     ConversationMessage,
@@ -584,6 +636,7 @@ async def handle_message(message: cl.Message) -> None:
       "conversation_id": conversation_id,
       "role": "assistant",
       "content": final_response,
+      "timestamp": datetime.now(),
     },
   )
   cm.add_message_background(
@@ -592,6 +645,56 @@ async def handle_message(message: cl.Message) -> None:
   )
 
 
+async def handle_multiple_intents(
+  intents: list[str],
+  history: list[Message],
+) -> str | dict[str, Any] | list[dict[str, Any]]:
+  """Handle several intents and synthesize a response"""
+  # The handlers are independent of each other, so run
+  # them concurrently. Their output is suppressed so
+  # their streams don't interleave in the UI.
+  intent_responses = await asyncio.gather(
+    *(
+      INTENT_HANDLERS.get(
+        intent, handle_general_intent
+      )(
+        messages=history,
+        suppress_output=True,
+      )
+      for intent in intents
+    )
+  )
+  all_responses: list[Message] = [
+    response
+    for intent_messages in intent_responses
+    for response in intent_messages
+  ]
+
+  if len(all_responses) <= 1:
+    return all_responses[0]["content"]
+
+  final_prompt = MULTI_INTENT_SYNTHESIS_PROMPT.render(
+    previous_responses="\n".join(
+      [
+        str(m["content"])
+        for m in all_responses
+        if m["role"] == "assistant"
+      ]
+    )
+  )
+  final_message = cast(
+    Message,
+    {"role": "user", "content": final_prompt},
+  )
+  history.append(final_message)
+  final_response = await call_llm_and_tool(
+    messages=history,
+    params=MULTI_INTENT_SYNTHESIS_PROMPT.params,
+  )
+  assert isinstance(final_response, str)
+  return final_response
+
+
 async def handle_intent(
   messages: list[Message],
   prompt: Prompt,
@@ -637,18 +740,20 @@ async def handle_intent(
   if isinstance(response, dict):
     # Create some temporary messages to provide
     # context to the LLM
-    tmp_messages = tmp_messages + [
-      response,
-      cast(
-        Message,
-        {
-          "role": "user",
-          "content": FUNCTION_CALL_RESPONSE_PROMPT.template,
-        },
-      ),
-    ]
+    tmp_messages.extend(
+      [
+        response,
+        cast(
+          Message,
+          {
+            "role": "user",
+            "content": FUNCTION_CALL_RESPONSE_PROMPT.template,
+          },
+        ),
+      ]
+    )
     response = await call_llm_and_tool(
-      messages=messages[:-1] + tmp_messages,
+      messages=tmp_messages,
       params=FUNCTION_CALL_RESPONSE_PROMPT.params,
       suppress_output=suppress_output,
     )
@@ -669,34 +774,10 @@ async def handle_weather_intent(
   suppress_output: bool = False,
 ) -> list[Message]:
   """Handle the weather intent"""
-  tools = [
-    {
-      "type": "function",  # Add this line
-      "function": {  # Wrap the existing content in a 'function' key
-        "name": "get_current_weather",
-        "description": "Get the current weather in a given location",
-        "parameters": {
-          "type": "object",
-          "properties": {
-            "location": {
-              "type": "string",
-              "description": "The city and state, e.g. San Francisco, CA",
-            },
-            "unit": {
-              "type": "string",
-              "enum": ["celsius", "fahrenheit"],
-            },
-          },
-          "required": ["location"],
-        },
-      },
-    }
-  ]
-
   return await handle_intent(
     messages=messages,
     prompt=WEATHER_INTENT_PROMPT,
-    tools=tools,
+    tools=WEATHER_TOOLS,
     suppress_output=suppress_output,
   )
 
@@ -793,12 +874,19 @@ async def handle_question_intent(
 
   # Prepare the context for the response
   context = str(retrieved_content)
-  print(f"Retrieved context: {context}")
+  logger.opt(lazy=True).trace(
+    "Retrieved context: {}", lambda: context[:500]
+  )
 
-  # Calculate the confidence level
-  confidence = sum(
-    item.similarity for item in retrieved_content
-  ) / len(retrieved_content)
+  # Calculate the confidence level, which is zero if
+  # nothing relevant was retrieved
+  confidence = (
+    fmean(
+      item.similarity for item in retrieved_content
+    )
+    if retrieved_content
+    else 0.0
+  )
 
   # Prepare the prompt variables
   prompt_vars = {
@@ -813,3 +901,17 @@ async def handle_question_intent(
     prompt_vars=prompt_vars,
     suppress_output=suppress_output,
   )
+
+
+# Handlers for each intent, built once rather than on
+# every message
+INTENT_HANDLERS = MappingProxyType(
+  {
+    "weather": handle_weather_intent,
+    "task": handle_task_intent,
+    "help": handle_help_intent,
+    "general": handle_general_intent,
+    "remember": handle_remember_intent,
+    "question": handle_question_intent,
+  }
+)
@@ -14,6 +14,7 @@ def kms():
   yield kms
 
   # Teardown
+  kms.close()
   kms.graph.conn.close()
   for root, dirs, files in os.walk(
     test_db_dir, topdown=False
@@ -1,4 +1,8 @@
-from unittest.mock import MagicMock, patch
+from unittest.mock import (
+  MagicMock,
+  PropertyMock,
+  patch,
+)
 
 import pytest
 from qa_index import QAIndex
@@ -111,6 +115,31 @@ def test_add_qa_with_rewordings(qa_index):
       }
 
 
+def test_add_qa_pairs(qa_index):
+  with patch.object(
+    qa_index.collection, "add"
+  ) as mock_add:
+    result = qa_index.add_qa_pairs(
+      [
+        {"q": "Question 1?", "a": "Answer 1."},
+        {"q": "Question 2?", "a": "Answer 2."},
+      ],
+      metadata={"content_id": "test1"},
+    )
+    mock_add.assert_called_once()
+    kwargs = mock_add.call_args.kwargs
+    assert kwargs["documents"] == [
+      "Question 1?",
+      "Question 2?",
+    ]
+    assert kwargs["metadatas"][1] == {
+      "content_id": "test1",
+      "answer": "Answer 2.",
+    }
+    assert len(set(kwargs["ids"])) == 2
+    assert result == 2
+
+
 def test_query(qa_index):
   mock_results = {
     "documents": [["Test question?"]],
@@ -131,6 +160,93 @@ def test_query(qa_index):
     )
 
 
+def fake_embed(texts):
+  # Deterministic stand-in for the embedding model
+  return [
+    [float(len(text)), float(sum(map(ord, text)) % 97)]
+    for text in texts
+  ]
+
+
+@pytest.fixture
+def stubbed_qa_index(qa_index):
+  collection = MagicMock()
+  collection.count.return_value = 0
+  embedding_function = MagicMock(
+    side_effect=fake_embed
+  )
+  with (
+    patch.object(
+      QAIndex,
+      "collection",
+      new_callable=PropertyMock,
+      return_value=collection,
+    ),
+    patch.object(
+      QAIndex,
+      "embedding_function",
+      new_callable=PropertyMock,
+      return_value=embedding_function,
+    ),
+  ):
+    yield qa_index, collection, embedding_function
+
+
+@pytest.mark.asyncio
+async def test_query_batches_questions(
+  stubbed_qa_index,
+):
+  qa_index, collection, _ = stubbed_qa_index
+  collection.query.return_value = {
+    "documents": [["Question 1?"], ["Question 2?"]],
+    "metadatas": [
+      [{"answer": "Answer 1."}],
+      [{"answer": "Answer 2."}],
+    ],
+    "distances": [[0.1], [0.2]],
+  }
+
+  result = await qa_index.query(
+    ["Question 1?", "Question 2?"], num_rewordings=1
+  )
+
+  collection.query.assert_called_once()
+  kwargs = collection.query.call_args.kwargs
+  assert kwargs["query_embeddings"] == fake_embed(
+    ["Question 1?", "Question 2?"]
+  )
+  assert [r["answer"] for r in result] == [
+    "Answer 1.",
+    "Answer 2.",
+  ]
+
+
+@pytest.mark.asyncio
+async def test_query_cache(stubbed_qa_index):
+  qa_index, collection, embedding_function = (
+    stubbed_qa_index
+  )
+  collection.query.return_value = {
+    "documents": [["Test question?"]],
+    "metadatas": [[{"answer": "Test answer."}]],
+    "distances": [[0.1]],
+  }
+
+  first = await qa_index.query("Test question?")
+  second = await qa_index.query("Test question?")
+  assert first == second
+  collection.query.assert_called_once()
+
+  # A write invalidates the cached results, but not
+  # the embedding of the question
+  qa_index.add_qa_pairs(
+    [{"q": "New question?", "a": "New answer."}]
+  )
+  _ = await qa_index.query("Test question?")
+  assert collection.query.call_count == 2
+  embedding_function.assert_called_once()
+
+
 def test_update_answer(qa_index):
   mock_query_result = {
     "ids": [["test_id"]],
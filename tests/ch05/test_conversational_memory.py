@@ -1,7 +1,10 @@
 import asyncio
 import os
 import sqlite3
+import threading
 import uuid
+from concurrent.futures import wait
+from unittest.mock import AsyncMock, patch
 from uuid import UUID
 
 import pytest
@@ -24,7 +27,6 @@ def cm():
   )
 
   def reset_state():
-    cm.active_conversations.clear()
     cm.conn.execute("DELETE FROM conversations")
     cm.conn.execute("DELETE FROM messages")
     cm.conn.commit()
@@ -35,6 +37,8 @@ def cm():
 
   # Teardown
   cm.reset_state()
+  cm.close()
+  kms.close()
   cm.conn.close()
   for root, dirs, files in os.walk(
     test_db_dir, topdown=False
@@ -250,6 +254,94 @@ async def test_summary_interval(cm):
   assert "Message 2" in conversation.summary
 
 
+@pytest.mark.asyncio
+async def test_summary_within_message_batch(cm):
+  conversation_id = cm.create_conversation()
+
+  def make_message(role, content):
+    return ConversationMessage(
+      id=generate_unique_id(),
+      conversation_id=conversation_id,
+      role=role,
+      content=content,
+    )
+
+  with (
+    patch.object(cm, "max_message_history", 3),
+    patch.object(
+      cm, "summarize_messages", new=AsyncMock()
+    ) as mock_summarize,
+  ):
+    await cm.add_messages(
+      conversation_id,
+      [
+        make_message("system", "System"),
+        make_message("user", "User 1"),
+        make_message("assistant", "Assistant 1"),
+      ],
+      bypass_ingestion=True,
+    )
+    mock_summarize.assert_not_awaited()
+
+    # The summary falls due between the two messages
+    # of the turn, so it covers the user message
+    await cm.add_messages(
+      conversation_id,
+      [
+        make_message("user", "User 2"),
+        make_message("assistant", "Assistant 2"),
+      ],
+      bypass_ingestion=True,
+    )
+    mock_summarize.assert_awaited_once()
+    summarized = [
+      m["content"]
+      for m in mock_summarize.await_args.kwargs[
+        "messages"
+      ]
+    ]
+    assert "User 2" in summarized
+    assert "Assistant 2" not in summarized
+
+
+@pytest.mark.asyncio
+async def test_background_write_stored_before_ingestion(
+  cm,
+):
+  conversation_id = cm.create_conversation()
+  message = ConversationMessage(
+    id=generate_unique_id(),
+    conversation_id=conversation_id,
+    role="user",
+    content="Stored before ingestion",
+  )
+  release = threading.Event()
+
+  async def slow_ingest(content):
+    while not release.is_set():
+      await asyncio.sleep(0.01)
+
+  with patch.object(
+    cm.kms, "ingest_content", new=slow_ingest
+  ):
+    cm.add_message_background(conversation_id, message)
+    await asyncio.wait_for(
+      cm.wait_for_background_writes(conversation_id),
+      timeout=5,
+    )
+    row = cm.conn.execute(
+      "SELECT content FROM messages WHERE id = ?",
+      (str(message["id"]),),
+    ).fetchone()
+    assert row["content"] == "Stored before ingestion"
+    assert cm.pending_tasks
+
+    release.set()
+    _ = await asyncio.to_thread(
+      wait, list(cm.pending_tasks)
+    )
+
+
 @pytest.mark.asyncio
 async def test_multiple_conversations(cm):
   conv_id1 = cm.create_conversation()